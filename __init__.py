@@ -1,8 +1,16 @@
+import asyncio
 import httpx
 import random
-from typing import Dict, List
-from pydantic import BaseModel, Field, HttpUrl
-from urllib.parse import quote
+import time
+from collections import OrderedDict
+from importlib.util import find_spec
+from typing import Dict, List, Optional, Tuple
+from pydantic import Field
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    from json import loads as json_loads
 
 from nekro_agent.services.plugin.base import NekroPlugin, ConfigBase, SandboxMethodType
 from nekro_agent.api.schemas import AgentCtx
@@ -50,6 +58,205 @@ class EmojiSearchConfig(ConfigBase):
 # 获取配置
 config = plugin.get_config(EmojiSearchConfig)
 
+# 安装了 h2 (httpx[http2]) 时启用 HTTP/2，否则回退到 HTTP/1.1
+_HTTP2_ENABLED = find_spec("h2") is not None
+
+# 共享的HTTP客户端，复用连接池，在插件清理时关闭
+_client: Optional[httpx.AsyncClient] = None
+
+async def get_client() -> httpx.AsyncClient:
+    """获取共享的HTTP客户端，首次调用时创建
+
+    超时时间不固化在客户端上，由每次请求按当前配置传入，以便配置修改后立即生效。
+
+    Returns:
+        httpx.AsyncClient: 复用连接池的异步HTTP客户端
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
+            http2=_HTTP2_ENABLED,
+        )
+    return _client
+
+# 并发请求上限与限流重试策略，公共ID共享调用频次，避免突发请求触发429
+_MAX_CONCURRENT_REQUESTS = 8
+_MAX_RETRIES = 3
+_RETRY_BASE_DELAY = 0.5
+_RETRY_MAX_DELAY = 10.0
+_RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+_semaphore: Optional[asyncio.Semaphore] = None
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """获取限制并发请求数的信号量，首次调用时创建"""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """计算重试等待时间，优先使用服务端返回的 Retry-After"""
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(float(retry_after), _RETRY_MAX_DELAY)
+    return min(_RETRY_BASE_DELAY * 2**attempt, _RETRY_MAX_DELAY)
+
+async def request_get(url: str, **kwargs) -> httpx.Response:
+    """在并发限制下发送GET请求，遇到429/5xx时指数退避重试
+
+    Args:
+        url: 请求地址
+        **kwargs: 透传给 httpx.AsyncClient.get 的参数
+
+    Returns:
+        httpx.Response: 最后一次请求的响应
+    """
+    client = await get_client()
+    attempt = 0
+    while True:
+        async with _get_semaphore():
+            response = await client.get(url, timeout=config.TIMEOUT, **kwargs)
+        if response.status_code not in _RETRY_STATUS_CODES or attempt >= _MAX_RETRIES:
+            return response
+        await asyncio.sleep(_retry_delay(response, attempt))
+        attempt += 1
+
+_IMAGE_CHUNK_SIZE = 65536
+
+# 图片条件请求缓存: URL -> (ETag, Last-Modified, 图片数据)
+_IMAGE_CACHE_SIZE = 64
+_image_cache: "OrderedDict[str, Tuple[Optional[str], Optional[str], bytes]]" = OrderedDict()
+
+def _conditional_headers(entry: Optional[Tuple[Optional[str], Optional[str], bytes]]) -> Dict[str, str]:
+    """根据已缓存的校验信息构造条件请求头"""
+    if entry is None:
+        return {}
+    etag, last_modified, _ = entry
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+def _store_image(url: str, response: httpx.Response, content: bytes) -> None:
+    """缓存带有校验信息的图片，超出容量时淘汰最久未使用的条目"""
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+    _image_cache[url] = (etag, last_modified, content)
+    _image_cache.move_to_end(url)
+    while len(_image_cache) > _IMAGE_CACHE_SIZE:
+        _image_cache.popitem(last=False)
+
+async def download_image(url: str) -> bytes:
+    """以流式方式下载图片，并发限制与重试策略同 request_get
+
+    已缓存的图片会带上 If-None-Match/If-Modified-Since 条件请求，服务端返回304时直接使用缓存数据。
+
+    Args:
+        url: 图片地址
+
+    Returns:
+        bytes: 图片的二进制数据
+
+    Raises:
+        httpx.RequestError: 网络请求错误
+        httpx.HTTPStatusError: HTTP状态码错误
+    """
+    client = await get_client()
+    # 在发送请求前取出缓存快照，请求期间条目被淘汰或替换时仍能正确处理304
+    cached = _image_cache.get(url)
+    headers = _conditional_headers(cached)
+    attempt = 0
+    while True:
+        async with _get_semaphore(), client.stream("GET", url, headers=headers, timeout=config.TIMEOUT) as response:
+            if response.status_code == 304 and cached is not None:
+                if url in _image_cache:
+                    _image_cache.move_to_end(url)
+                return cached[2]
+            if response.status_code not in _RETRY_STATUS_CODES or attempt >= _MAX_RETRIES:
+                response.raise_for_status()
+                buf = bytearray()
+                async for chunk in response.aiter_bytes(_IMAGE_CHUNK_SIZE):
+                    buf += chunk
+                content = bytes(buf)
+                _store_image(url, response, content)
+                return content
+            delay = _retry_delay(response, attempt)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+# 搜索后在后台预取图片，get_emoji_image 命中时直接等待已有任务
+_PREFETCH_TOP_K = 3
+_PREFETCH_MAX_TASKS = 16
+_prefetch: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+
+def _discard_task_result(task: asyncio.Task) -> None:
+    """取走未被使用的预取任务结果，避免 'exception was never retrieved' 警告"""
+    if not task.cancelled():
+        task.exception()
+
+def _prefetch_failed(task: asyncio.Task) -> bool:
+    """预取任务是否已以异常或取消结束"""
+    return task.done() and (task.cancelled() or task.exception() is not None)
+
+async def _take_prefetched(url: str) -> Optional[bytes]:
+    """取出URL对应的预取结果，没有预取或预取失败时返回 None，由调用方重新下载"""
+    task = _prefetch.pop(url, None)
+    if task is None:
+        return None
+    # asyncio.wait 不会抛出任务自身的异常，预取失败只回退到重新下载
+    await asyncio.wait({task})
+    if _prefetch_failed(task):
+        return None
+    return task.result()
+
+def prefetch_images(urls: List[str]) -> None:
+    """为给定的图片URL创建后台下载任务，超出容量时取消最早的任务
+
+    Args:
+        urls: 需要预取的图片URL列表
+    """
+    for url in urls:
+        existing = _prefetch.get(url)
+        if existing is not None:
+            if not _prefetch_failed(existing):
+                continue
+            del _prefetch[url]
+        task = asyncio.create_task(download_image(url))
+        task.add_done_callback(_discard_task_result)
+        _prefetch[url] = task
+    while len(_prefetch) > _PREFETCH_MAX_TASKS:
+        _, stale = _prefetch.popitem(last=False)
+        stale.cancel()
+
+# 搜索结果缓存: (关键词, 数量, 页码) -> (写入时间, API返回数据)
+_SEARCH_CACHE_SIZE = 256
+_SEARCH_CACHE_TTL = 600.0
+_search_cache: "OrderedDict[Tuple[str, int, int], Tuple[float, Dict]]" = OrderedDict()
+
+def _get_cached_search(key: Tuple[str, int, int]) -> Optional[Dict]:
+    """读取未过期的搜索缓存，命中时刷新其LRU位置"""
+    entry = _search_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, data = entry
+    if time.monotonic() - stored_at > _SEARCH_CACHE_TTL:
+        del _search_cache[key]
+        return None
+    _search_cache.move_to_end(key)
+    return data
+
+def _set_cached_search(key: Tuple[str, int, int], data: Dict) -> None:
+    """写入搜索缓存，超出容量时淘汰最久未使用的条目"""
+    _search_cache[key] = (time.monotonic(), data)
+    _search_cache.move_to_end(key)
+    while len(_search_cache) > _SEARCH_CACHE_SIZE:
+        _search_cache.popitem(last=False)
+
 async def fetch_emoji_images(keyword: str, limit: int = 1, page: int = 1) -> Dict:
     """从API获取表情包图片数据
     
@@ -67,20 +274,27 @@ async def fetch_emoji_images(keyword: str, limit: int = 1, page: int = 1) -> Dic
         ValueError: 数据解析错误
     """
     full_keyword = f"{keyword} {config.EXTRA_KEYWORD}".strip()
-    encoded_keyword = quote(full_keyword)
-    
+    # 缓存键使用拼接后的完整关键词，额外关键词修改后不会命中旧结果
+    cache_key = (full_keyword.lower(), limit, page)
+    cached = _get_cached_search(cache_key)
+    if cached is not None:
+        return cached
+
     params = {
         "id": config.USER_ID,
         "key": config.USER_KEY,
-        "words": encoded_keyword,
+        "words": full_keyword,
         "limit": limit,
         "page": page
     }
     
-    async with httpx.AsyncClient(timeout=config.TIMEOUT) as client:
-        response = await client.post(config.API_URL, params=params)
-        response.raise_for_status()
-        return response.json()
+    response = await request_get(config.API_URL, params=params)
+    response.raise_for_status()
+    data = json_loads(response.content)
+    # 仅缓存成功的结果，避免把限流等错误缓存下来
+    if isinstance(data, dict) and data.get("code") == 200:
+        _set_cached_search(cache_key, data)
+    return data
 
 def format_result(data: Dict) -> str:
     """格式化API返回结果
@@ -110,6 +324,26 @@ def format_result(data: Dict) -> str:
         f"随机选择一个: {random.choice(res_list)}"
     )
 
+# 异常类型 -> (日志模板, 返回给调用方的消息模板)，按异常类的MRO匹配最具体的一项
+_SEARCH_ERRORS: Dict[type, Tuple[str, str]] = {
+    httpx.RequestError: ("表情包搜索请求失败: {}", "表情包搜索失败，无法连接到服务: {e}"),
+    httpx.HTTPStatusError: ("表情包搜索HTTP错误: {}", "表情包搜索失败，服务返回错误: {e.response.status_code}"),
+    KeyError: ("表情包数据解析错误: {}", "表情包数据解析失败: {e}"),
+    ValueError: ("表情包数据解析错误: {}", "表情包数据解析失败: {e}"),
+    Exception: ("表情包搜索未知错误: {}", "表情包搜索发生未知错误: {e}"),
+}
+_IMAGE_ERRORS: Dict[type, Tuple[str, str]] = {
+    httpx.RequestError: ("图片下载失败: {}", "无法下载图片: {e}"),
+    httpx.HTTPStatusError: ("图片下载HTTP错误: {}", "图片下载失败，HTTP状态码: {e.response.status_code}"),
+    Exception: ("图片下载未知错误: {}", "图片下载发生未知错误: {e}"),
+}
+
+def _handle_error(table: Dict[type, Tuple[str, str]], e: Exception) -> str:
+    """按异常类型记录日志，并返回格式化后的错误消息"""
+    log_template, message_template = next(table[cls] for cls in type(e).__mro__ if cls in table)
+    logger.opt(depth=1).error(log_template, e)
+    return message_template.format(e=e)
+
 @plugin.mount_sandbox_method(
     SandboxMethodType.MULTIMODAL_AGENT,
     name="搜索表情包",
@@ -130,19 +364,13 @@ async def search_emoji(_ctx: AgentCtx, keyword: str) -> str:
     try:
         # 获取表情包数据
         data = await fetch_emoji_images(keyword)
-        return format_result(data)
-    except httpx.RequestError as e:
-        logger.error(f"表情包搜索请求失败: {e}")
-        return f"表情包搜索失败，无法连接到服务: {str(e)}"
-    except httpx.HTTPStatusError as e:
-        logger.error(f"表情包搜索HTTP错误: {e}")
-        return f"表情包搜索失败，服务返回错误: {e.response.status_code}"
-    except (KeyError, ValueError) as e:
-        logger.error(f"表情包数据解析错误: {e}")
-        return f"表情包数据解析失败: {str(e)}"
+        result = format_result(data)
     except Exception as e:
-        logger.error(f"表情包搜索未知错误: {e}")
-        return f"表情包搜索发生未知错误: {str(e)}"
+        return _handle_error(_SEARCH_ERRORS, e)
+    else:
+        # 搜索只请求一条结果，切片保证上游返回更多结果时也只预取少量图片
+        prefetch_images(data["res"][:_PREFETCH_TOP_K])
+        return result
 
 @plugin.mount_sandbox_method(
     SandboxMethodType.TOOL,
@@ -162,22 +390,25 @@ async def get_emoji_image(_ctx: AgentCtx, image_url: str) -> bytes:
         get_emoji_image("https://example.com/image.jpg")
     """
     try:
-        async with httpx.AsyncClient(timeout=config.TIMEOUT) as client:
-            response = await client.get(image_url)
-            response.raise_for_status()
-            return response.content
-    except httpx.RequestError as e:
-        logger.error(f"图片下载失败: {e}")
-        raise ValueError(f"无法下载图片: {str(e)}")
-    except httpx.HTTPStatusError as e:
-        logger.error(f"图片下载HTTP错误: {e}")
-        raise ValueError(f"图片下载失败，HTTP状态码: {e.response.status_code}")
+        content = await _take_prefetched(image_url)
+        if content is None:
+            content = await download_image(image_url)
     except Exception as e:
-        logger.error(f"图片下载未知错误: {e}")
-        raise ValueError(f"图片下载发生未知错误: {str(e)}")
+        raise ValueError(_handle_error(_IMAGE_ERRORS, e))
+    return content
 
 @plugin.mount_cleanup_method()
 async def clean_up():
     """清理插件资源"""
-    # 如有必要，在此实现清理资源的逻辑
+    global _client, _semaphore
+    # 先取消进行中的预取，再关闭客户端，避免预取任务在已关闭的连接上失败
+    for task in _prefetch.values():
+        task.cancel()
+    _prefetch.clear()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _semaphore = None
+    _search_cache.clear()
+    _image_cache.clear()
     logger.info("表情包搜索插件资源已清理")